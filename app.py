@@ -4,14 +4,19 @@ import sqlite3
 from datetime import datetime
 import os
 import io
-import tempfile
 from groq import Groq
 import base64
 import time
 import json
-from collections import Counter
+import re
+import threading
 import random
+from itertools import takewhile
+from concurrent.futures import ThreadPoolExecutor
 from statistics import mean
+from urllib.parse import quote
+import numpy as np
+import pandas as pd
 
 # ✅ Must be FIRST Streamlit command
 st.set_page_config(page_title="🧘 MindMate", layout="wide")
@@ -88,152 +93,498 @@ if not _api_key:
 client = get_groq_client(_api_key)
 
 # ✅ Text-to-Speech using gTTS
+@st.cache_data(show_spinner=False, max_entries=256, ttl=24*60*60)
+def _tts_bytes(text: str, lang: str = 'en') -> bytes:
+    """Synthesize text once per (text, lang); repeated cues like "Inhale" hit the cache."""
+    # imported on first synthesis: gtts pulls in requests (~30ms), which voice-off sessions never need
+    from gtts import gTTS
+    tts = gTTS(text=text, lang=lang)
+    buf = io.BytesIO()
+    tts.write_to_fp(buf)
+    buf.seek(0)
+    return buf.read()
+
 def text_to_speech(text):
     try:
-        from gtts import gTTS
-        tts = gTTS(text=text, lang='en')
-        buf = io.BytesIO()
-        tts.write_to_fp(buf)
-        buf.seek(0)
-        return buf.read()
+        return _tts_bytes(text)
     except Exception as e:
         st.error(f"⚠️ TTS error: {e}")
         return None
 
+def play_audio(source, autoplay=True):
+    """Play MP3 bytes (or a URL) via st.audio, which serves them from Streamlit's media
+    endpoint instead of inlining a base64 data URI into the page."""
+    st.audio(source, format='audio/mp3', autoplay=autoplay)
+
+@st.cache_data(show_spinner=False, max_entries=64, ttl=24*60*60)
+def tts_data_uri(text):
+    """Synthesized speech as a ready-to-embed data URI, so repeated cues skip the base64 step."""
+    return "data:audio/mp3;base64," + base64.b64encode(_tts_bytes(text)).decode('utf-8')
+
+def prefetch_tts(texts, synth=_tts_bytes):
+    """Synthesize several cues in parallel and return synth's result per text (None on failure).
+
+    Worker threads only call the cached synthesizer; errors are reported from the
+    script thread so st.error still reaches the page.
+    """
+    def _fetch(t):
+        try:
+            return synth(t), None
+        except Exception as e:
+            return None, e
+
+    with ThreadPoolExecutor(max_workers=max(1, len(texts))) as ex:
+        results = list(ex.map(_fetch, texts))
+    errors = [e for _, e in results if e]
+    if errors:
+        st.error(f"⚠️ TTS error: {errors[0]}")
+    return [audio for audio, _ in results]
+
+
+# Words ending in "." that don't end a sentence.
+_ABBREVIATIONS = {'dr.', 'mr.', 'mrs.', 'ms.', 'st.', 'vs.', 'etc.', 'e.g.', 'i.e.'}
+
+def is_sentence_boundary(buffer, token):
+    """Return True when `buffer` ends a sentence and `token` starts the next one.
+
+    Requiring whitespace between them, either opening `token` or closing `buffer`
+    (".\n\n" then "Here"), keeps decimals ("3.5") and abbreviations ("Dr. Lee")
+    from being split mid-sentence. List numbers ("1.") are not sentence ends.
+    """
+    if not (token[:1].isspace() or buffer[-1:].isspace()):
+        return False
+    tail = buffer.rstrip().rstrip('"\')]')
+    if not tail.endswith(('.', '!', '?')):
+        return False
+    words = tail.split()
+    if not words:
+        return False
+    last = words[-1].lower()
+    return last not in _ABBREVIATIONS and not (last.endswith('.') and last[:-1].isdigit())
+
+def stream_tokens(stream):
+    """Yield the text deltas of a streamed chat completion (for st.write_stream)."""
+    for chunk in stream:
+        token = chunk.choices[0].delta.content or ""
+        if token:
+            yield token
+
+_MOOD_TAG_RE = re.compile(r'\s*\[mood:\s*([^\]]*)\]\s*', re.IGNORECASE)
+
+def strip_mood_tag(tokens, found):
+    """Yield tokens with a leading "[mood: X]" tag removed, storing X in found['mood'].
+
+    Lets one streamed completion carry both the mood label and the reply. If the
+    reply doesn't open with a tag, tokens pass through unchanged.
+    """
+    head = ""
+    for token in tokens:
+        if head is None:
+            yield token
+            continue
+        head += token
+        m = _MOOD_TAG_RE.match(head)
+        if m:
+            found['mood'] = m.group(1).strip()
+            rest, head = head[m.end():], None
+            if rest:
+                yield rest
+            continue
+        probe = head.lstrip().lower()
+        if ']' in head or len(head) > 60 or not (probe.startswith('[mood:') or '[mood:'.startswith(probe)):
+            rest, head = head, None
+            yield rest
+    if head:
+        yield head
+
+def stream_reply_with_tts(tokens, speak):
+    """Render streamed reply tokens as they arrive, synthesizing each finished sentence.
+
+    Returns (reply_text, audio_bytes). Sentence audio is produced in the background
+    while later tokens are still streaming, then joined in order (MP3 frames
+    concatenate cleanly), so playback is ready shortly after the last token.
+    """
+    futures = []
+
+    def _speak_as_you_go(ex):
+        buffer = ""
+        for token in tokens:
+            if speak and buffer.strip() and is_sentence_boundary(buffer, token):
+                futures.append(ex.submit(_tts_bytes, buffer.strip()))
+                buffer = ""
+            buffer += token
+            yield token
+        if speak and buffer.strip():
+            futures.append(ex.submit(_tts_bytes, buffer.strip()))
+
+    with ThreadPoolExecutor(max_workers=2) as ex:
+        reply = st.write_stream(_speak_as_you_go(ex))
+
+        audio = b""
+        for fut in futures:
+            try:
+                audio += fut.result()
+            except Exception as e:
+                st.error(f"⚠️ TTS error: {e}")
+                break
+    return str(reply or "").strip(), (audio or None)
+
+
+def breathing_session_html(phases, cycles, cue_uris):
+    """Return a self-contained HTML page that runs a guided breathing session.
+
+    phases is a list of (label, seconds) repeated `cycles` times; cue_uris maps a
+    label to an audio data URI (or None) played when that phase starts. A CSS animation
+    drives the breathing circle and a small script advances the label, progress
+    bar and audio cues on wall-clock deadlines, so nothing blocks the server.
+    """
+    cycle_seconds = sum(sec for _, sec in phases)
+    # circle grows on Inhale, shrinks on Exhale, holds otherwise
+    frames = []
+    t, scale = 0, 0.6
+    for label, sec in phases:
+        frames.append(f"{100 * t / cycle_seconds:.2f}% {{ transform: scale({scale}); }}")
+        if label.startswith("Inhale"):
+            scale = 1.0
+        elif label.startswith("Exhale"):
+            scale = 0.6
+        t += sec
+    frames.append(f"100% {{ transform: scale({scale}); }}")
+
+    cues = {label: uri for label, uri in cue_uris.items() if uri}
+
+    return f"""
+<style>
+  body {{ font-family: sans-serif; text-align: center; margin: 0; }}
+  @keyframes breathe {{ {' '.join(frames)} }}
+  #circle {{ width: 200px; height: 200px; margin: 24px auto; border-radius: 50%;
+             background: radial-gradient(#b5e3d8, #6cb4a5); transform: scale(0.6);
+             animation: breathe {cycle_seconds}s linear {cycles}; }}
+  #bar {{ height: 8px; background: #eee; border-radius: 4px; margin: 0 24px; }}
+  #fill {{ height: 100%; width: 0; background: #6cb4a5; border-radius: 4px; }}
+</style>
+<h3 id="label"></h3>
+<div id="circle"></div>
+<div id="bar"><div id="fill"></div></div>
+<script>
+  const phases = {json.dumps(phases)};
+  const cycles = {cycles};
+  const cues = {json.dumps(cues)};
+  const clips = {{}};
+  for (const k in cues) clips[k] = new Audio(cues[k]);
+  const total = {cycle_seconds} * cycles;
+  const start = performance.now();
+  let step = 0, elapsed = 0;
+  function next() {{
+    if (step >= phases.length * cycles) {{
+      document.getElementById("label").textContent = "✔️ Session complete — well done!";
+      document.getElementById("fill").style.width = "100%";
+      return;
+    }}
+    const [label, sec] = phases[step % phases.length];
+    const cycle = Math.floor(step / phases.length) + 1;
+    document.getElementById("label").textContent =
+      cycles > 1 ? `Cycle ${{cycle}}/${{cycles}}: ${{label}} (${{sec}}s)` : label;
+    if (clips[label]) {{ clips[label].currentTime = 0; clips[label].play().catch(() => {{}}); }}
+    elapsed += sec;
+    step += 1;
+    // schedule against the session start so timing doesn't drift across cycles
+    setTimeout(next, Math.max(0, start + elapsed * 1000 - performance.now()));
+  }}
+  setInterval(() => {{
+    const pct = Math.min((performance.now() - start) / (total * 1000), 1);
+    document.getElementById("fill").style.width = (pct * 100) + "%";
+  }}, 500);
+  next();
+</script>
+"""
+
+# st.iframe replaces components.v1.html (deprecated upstream); older releases only ship the latter.
+_IFRAME = getattr(st, 'iframe', None)
+
+def embed_html(html, height):
+    """Render a self-contained HTML/JS snippet in an iframe using whichever API this version provides."""
+    if _IFRAME:
+        _IFRAME(html, height=height)
+    else:
+        import streamlit.components.v1 as components
+        components.html(html, height=height)
+
 
 # ✅ Database setup
+@st.cache_resource
+def get_conn():
+    """Return the process-wide SQLite connection, opened once and tuned for reuse.
+
+    Autocommit mode (isolation_level=None) means each statement commits on its own,
+    so helpers don't need explicit commit() calls.
+    """
+    conn = sqlite3.connect('mindmate.db', check_same_thread=False, isolation_level=None)
+    conn.executescript("""
+    PRAGMA journal_mode=WAL;
+    PRAGMA synchronous=NORMAL;
+    PRAGMA temp_store=MEMORY;
+    PRAGMA cache_size=-64000;
+    PRAGMA mmap_size=268435456;
+    """)
+    return conn
+
+
+@st.cache_resource
+def get_db_lock():
+    """Lock guarding the shared connection across Streamlit sessions/threads."""
+    return threading.Lock()
+
+
 def init_db():
-    conn = sqlite3.connect('mindmate.db')
-    c = conn.cursor()
-    # chats table
-    c.execute("""
-    CREATE TABLE IF NOT EXISTS chats (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        timestamp TEXT,
-        user_message TEXT,
-        assistant_message TEXT,
-        mood TEXT
-    )""")
-    # journals table
-    c.execute("""
-    CREATE TABLE IF NOT EXISTS journals (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        date TEXT,
-        entry TEXT
-    )""")
-    # settings table for small key/value persistence
-    c.execute("""
-    CREATE TABLE IF NOT EXISTS settings (
-        key TEXT PRIMARY KEY,
-        value TEXT
-    )""")
-    conn.commit()
-    conn.close()
+    with get_db_lock():
+        c = get_conn()
+        # chats table
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS chats (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            timestamp TEXT,
+            user_message TEXT,
+            assistant_message TEXT,
+            mood TEXT
+        )""")
+        # journals table
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS journals (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            date TEXT,
+            entry TEXT
+        )""")
+        # settings table for small key/value persistence
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )""")
+        # covering index for newest-first history/mood reads
+        c.execute("CREATE INDEX IF NOT EXISTS idx_chats_recent ON chats(id DESC, timestamp, mood)")
 
 init_db()
 
+def _bump_version(name):
+    """Advance a per-session data version so cached readers refetch."""
+    st.session_state[name] = st.session_state.get(name, 0) + 1
+
+
+def _queue_write(sql, params, version_name):
+    """Buffer a write for this rerun; flush_writes() commits the batch in one transaction."""
+    st.session_state.setdefault('_pending_writes', []).append((sql, params))
+    _bump_version(version_name)
+
+
+def _commit_writes(ops):
+    """Commit (sql, params) ops in a single BEGIN…COMMIT, merging runs of the same INSERT."""
+    groups = []
+    for sql, params in ops:
+        if groups and groups[-1][0] == sql:
+            groups[-1][1].append(params)
+        else:
+            groups.append((sql, [params]))
+    with get_db_lock():
+        conn = get_conn()
+        conn.execute("BEGIN")
+        try:
+            for sql, rows in groups:
+                conn.executemany(sql, rows)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+
+def _clear_read_caches():
+    # other sessions key these caches on their own versions; drop entries so they refetch too
+    for cached in (_cached_chats, _cached_last_mood, _cached_daily_moods, _cached_mood_trend,
+                   _cached_journals):
+        cached.clear()
+
+
+def flush_writes():
+    """Commit this session's buffered writes in one transaction, then invalidate cached reads."""
+    pending = st.session_state.get('_pending_writes')
+    if not pending:
+        return
+    _commit_writes(pending)
+    pending.clear()
+    _clear_read_caches()
+
+
 def insert_chat(user_msg, bot_msg, mood):
-    conn = sqlite3.connect('mindmate.db')
-    c = conn.cursor()
-    c.execute("INSERT INTO chats (timestamp, user_message, assistant_message, mood) VALUES (?, ?, ?, ?)",
-              (datetime.now().strftime("%Y-%m-%d %H:%M:%S"), user_msg, bot_msg, mood))
-    conn.commit()
-    conn.close()
+    _queue_write("INSERT INTO chats (timestamp, user_message, assistant_message, mood) VALUES (?, ?, ?, ?)",
+                 (datetime.now().strftime("%Y-%m-%d %H:%M:%S"), user_msg, bot_msg, mood),
+                 'chats_version')
 def insert_journal(entry):
-    conn = sqlite3.connect('mindmate.db')
-    c = conn.cursor()
-    c.execute("INSERT INTO journals (date, entry) VALUES (?, ?)",
-              (datetime.now().strftime("%Y-%m-%d"), entry))
-    conn.commit()
-    conn.close()
-
-def get_chat_history():
-    conn = sqlite3.connect('mindmate.db')
-    c = conn.cursor()
-    c.execute("SELECT timestamp, user_message, assistant_message, mood FROM chats ORDER BY id DESC")
-    data = c.fetchall()
-    conn.close()
-    return data
+    _queue_write("INSERT INTO journals (date, entry) VALUES (?, ?)",
+                 (datetime.now().strftime("%Y-%m-%d"), entry),
+                 'journals_version')
+
+# Cached readers are keyed by a version counter bumped on every write, so idle
+# reruns (tab switches, slider moves) skip SQLite entirely. ttl caps memory.
+@st.cache_data(show_spinner=False, ttl=24*60*60)
+def _cached_chats(version, limit, offset=0):
+    sql = "SELECT timestamp, user_message, assistant_message, mood FROM chats ORDER BY id DESC"
+    params = ()
+    if limit is not None:
+        sql += " LIMIT ? OFFSET ?"
+        params = (limit, offset)
+    with get_db_lock():
+        rows = get_conn().execute(sql, params).fetchall()
+    return tuple(tuple(r) for r in rows)
+
+@st.cache_data(show_spinner=False, ttl=24*60*60)
+def _cached_last_mood(version):
+    with get_db_lock():
+        row = get_conn().execute("SELECT mood FROM chats ORDER BY id DESC LIMIT 1").fetchone()
+    return row[0] if row else None
+
+@st.cache_data(show_spinner=False, ttl=24*60*60)
+def _cached_daily_moods(version, n):
+    # SQLite fills bare columns from the MAX(id) row, i.e. each day's latest chat
+    with get_db_lock():
+        rows = get_conn().execute(
+            "SELECT substr(timestamp, 1, 10) AS d, mood, MAX(id) AS last_id FROM chats "
+            "GROUP BY d ORDER BY last_id DESC LIMIT ?", (n,)
+        ).fetchall()
+    return tuple((d, mood) for d, mood, _ in rows)
+
+@st.cache_data(show_spinner=False, ttl=24*60*60)
+def _cached_journals(version):
+    with get_db_lock():
+        rows = get_conn().execute("SELECT date, entry FROM journals ORDER BY id DESC").fetchall()
+    return tuple(tuple(r) for r in rows)
+
+def get_chat_history(limit=200, offset=0):
+    """Newest-first chat rows, skipping `offset`; pass limit=None for the full table."""
+    # reads see this rerun's buffered writes
+    flush_writes()
+    return _cached_chats(st.session_state.get('chats_version', 0), limit, offset)
+
+def get_last_mood():
+    """Mood of the most recent chat, or None."""
+    flush_writes()
+    return _cached_last_mood(st.session_state.get('chats_version', 0))
+
+def get_daily_moods(n):
+    """(date, mood) of the latest chat on each of the n most recent chat days."""
+    flush_writes()
+    return _cached_daily_moods(st.session_state.get('chats_version', 0), n)
+
+@st.cache_data(show_spinner=False, ttl=24*60*60)
+def _cached_mood_trend(version, limit, bins=6):
+    # One vectorized pass: lower-case moods, bucket rows by position, count pairs.
+    chats = _cached_chats(version, limit)
+    if not chats:
+        return None
+    df = pd.DataFrame(chats, columns=['ts', 'u', 'a', 'mood'])
+    df['mood'] = df['mood'].str.lower()
+    bucket_size = max(1, len(df) // bins)
+    df['bucket'] = np.arange(len(df)) // bucket_size
+    n_buckets = int(df['bucket'].iloc[-1]) + 1
+    labeled = df[df['mood'].fillna('') != '']
+    mood_ids, mood_names = pd.factorize(labeled['mood'], sort=True)
+    counts = bucket_mood_counts(labeled['bucket'].to_numpy(), mood_ids, n_buckets, len(mood_names))
+    return pd.DataFrame(counts, columns=[m.capitalize() for m in mood_names])
+
+def get_mood_trend(limit=200):
+    """Per-bucket mood counts over the newest `limit` chats (None when there are no chats)."""
+    flush_writes()
+    return _cached_mood_trend(st.session_state.get('chats_version', 0), limit)
 
 def get_journal_history():
-    conn = sqlite3.connect('mindmate.db')
-    c = conn.cursor()
-    c.execute("SELECT date, entry FROM journals ORDER BY id DESC")
-    data = c.fetchall()
-    conn.close()
-    return data
+    flush_writes()
+    return _cached_journals(st.session_state.get('journals_version', 0))
 
 
 # --- small settings persistence helpers ---------------------------------
+_JSON_LITERALS = {'true': True, 'false': False, 'null': None}
+
 def set_setting(key, value):
     """Persist a JSON-serializable setting value into the settings table."""
-    conn = sqlite3.connect('mindmate.db')
-    c = conn.cursor()
     try:
         store_val = json.dumps(value)
     except Exception:
         store_val = str(value)
-    c.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, store_val))
-    conn.commit()
-    conn.close()
+    with get_db_lock():
+        get_conn().execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, store_val))
+    _setting_raw.clear()
+    st.session_state.get('_settings_cache', {}).pop(key, None)
+
+
+@st.cache_data(show_spinner=False, ttl=60)
+def _setting_raw(key):
+    """Stored (still encoded) value for key, or None; cleared by set_setting."""
+    with get_db_lock():
+        row = get_conn().execute("SELECT value FROM settings WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else None
 
 
 def get_setting(key, default=None):
     """Return a Python object if stored as JSON, otherwise return the raw string or default."""
-    conn = sqlite3.connect('mindmate.db')
-    c = conn.cursor()
-    c.execute("SELECT value FROM settings WHERE key = ?", (key,))
-    row = c.fetchone()
-    conn.close()
-    if not row:
+    val = _setting_raw(key)
+    if val is None:
         return default
-    val = row[0]
+    # flags like voice_enabled are stored as bare JSON literals; skip the parser for them
+    if val in _JSON_LITERALS:
+        return _JSON_LITERALS[val]
     try:
         return json.loads(val)
     except Exception:
         return val
 
 
+def get_cached_setting(key, default=None):
+    """get_setting memoized in session state, so hot keys (profile, voice) hit SQLite
+    once per session rather than several times per rerun. set_setting invalidates it."""
+    cache = st.session_state.setdefault('_settings_cache', {})
+    if key not in cache:
+        cache[key] = get_setting(key)
+    val = cache[key]
+    return default if val is None else val
+
+
 def voice_allowed():
     """Return True when voice is enabled in session state and persisted settings."""
-    persisted = get_setting('voice_enabled', False)
+    persisted = get_cached_setting('voice_enabled', False)
     return bool(st.session_state.get('voice', False)) and bool(persisted)
 
 
+# st.rerun is the current name; older releases only ship experimental_rerun.
+_RERUN = getattr(st, 'rerun', None) or getattr(st, 'experimental_rerun', None)
+
 def safe_rerun():
-    """Try to rerun the Streamlit script in a way that's compatible across versions.
-    Falls back to a browser reload if st.experimental_rerun is unavailable.
+    """Rerun the Streamlit script using whichever rerun API this version provides.
+    Falls back to setting a session flag so the UI can react on the next run.
     """
-    try:
-        # preferred if available
-        getattr(st, 'experimental_rerun')()
-    except Exception:
-        # fallback: inject a small JS reload; this usually triggers a page refresh
-        try:
-            st.markdown("<script>window.location.reload()</script>", unsafe_allow_html=True)
-        except Exception:
-            # last resort: set a session flag so UI can react next run
-            st.session_state['_needs_reload'] = True
+    # a rerun aborts the script before its final flush
+    flush_writes()
+    if _RERUN:
+        _RERUN()
+    else:
+        st.session_state['_needs_reload'] = True
 
 
 # cheerful voice wrapper
+CHEERFUL_SUFFIX = 'You’re doing great! Keep going with a smile.'
+
 def tts_cheerful(text):
     # small wrapper to adjust wording for cheerfulness; keep gTTS call
-    cheerful_text = text.rstrip('.') + '. ' + 'You’re doing great! Keep going with a smile.'
+    cheerful_text = text.rstrip('.') + '. ' + CHEERFUL_SUFFIX
     return text_to_speech(cheerful_text)
 
 # ✅ Voice Transcription
 def transcribe_audio(audio_bytes):
     try:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as tmp:
-            tmp.write(audio_bytes)
-            path = tmp.name
-        with open(path, "rb") as file:
-            result = client.audio.transcriptions.create(
-                model="whisper-large-v3-turbo",
-                file=file
-            )
-        os.unlink(path)
+        # the SDK accepts a (filename, file, content_type) tuple, so no temp file is needed
+        buf = io.BytesIO(audio_bytes)
+        result = client.audio.transcriptions.create(
+            model="whisper-large-v3-turbo",
+            file=("audio.wav", buf, "audio/wav")
+        )
         return result.text
     except Exception as e:
         st.error(f"🎙️ Transcription error: {e}")
@@ -242,40 +593,26 @@ def transcribe_audio(audio_bytes):
 
 # -------------------- Mood analysis helpers --------------------
 NEGATIVE_KEYWORDS = ['sad', 'anx', 'depress', 'tired', 'low', 'down', 'worri', 'panic']
+POSITIVE_KEYWORDS = ['happy', 'joy', 'good', 'calm', 'relax']
+# single compiled alternations: one C-level scan instead of a Python loop per keyword
+NEG_RE = re.compile('|'.join(NEGATIVE_KEYWORDS), re.IGNORECASE)
+_POSITIVE_RE = re.compile('|'.join(POSITIVE_KEYWORDS), re.IGNORECASE)
+
+def is_negative(mood):
+    """True when a mood string contains any negative keyword."""
+    return bool(NEG_RE.search(mood or ''))
 
 def last_n_days_moods(n=14):
-    """Return the list of moods (strings) from the last n chats (most recent first)."""
-    chats = get_chat_history()  # already returns newest-first
-    moods = []
-    seen_dates = set()
-    for ts, _, _, mood in chats:
-        # only one mood per date
-        date = ts.split(' ')[0]
-        if date in seen_dates:
-            continue
-        seen_dates.add(date)
-        moods.append((date, (mood or '').lower()))
-        if len(moods) >= n:
-            break
-    return moods
+    """Return (date, mood) for the latest chat on each of the last n chat days (most recent first)."""
+    return [(date, (mood or '').lower()) for date, mood in get_daily_moods(n)]
 
 def count_negative_days(moods):
     """Count how many of the provided (date,mood) tuples are negative."""
-    c = 0
-    for _, mood in moods:
-        if any(k in (mood or '') for k in NEGATIVE_KEYWORDS):
-            c += 1
-    return c
+    return sum(is_negative(mood) for _, mood in moods)
 
 def negative_streak(moods):
     """Compute the current consecutive negative-day streak (from most recent going backwards)."""
-    streak = 0
-    for _, mood in moods:
-        if any(k in (mood or '') for k in NEGATIVE_KEYWORDS):
-            streak += 1
-        else:
-            break
-    return streak
+    return sum(1 for _ in takewhile(lambda dm: is_negative(dm[1]), moods))
 
 def positivity_score(mood):
     """Return a small numeric positivity score for a mood string (0..1).
@@ -283,13 +620,22 @@ def positivity_score(mood):
     """
     if not mood:
         return 0.5
-    m = mood.lower()
-    if any(k in m for k in NEGATIVE_KEYWORDS):
+    # both patterns are case-insensitive, so no .lower() copy is needed
+    if NEG_RE.search(mood):
         return 0.2
-    if any(k in m for k in ['happy', 'joy', 'good', 'calm', 'relax']):
+    if _POSITIVE_RE.search(mood):
         return 0.9
     return 0.5
 
+def bucket_mood_counts(buckets, mood_ids, n_buckets, n_moods):
+    """Return an (n_buckets, n_moods) count matrix for paired bucket/mood id arrays.
+
+    A single np.bincount over the flattened pair index; linear in rows and free of
+    the groupby overhead of pd.crosstab.
+    """
+    flat = np.asarray(buckets, dtype=np.int64) * n_moods + np.asarray(mood_ids, dtype=np.int64)
+    return np.bincount(flat, minlength=n_buckets * n_moods).reshape(n_buckets, n_moods)
+
 def gentle_depression_check_and_prompt():
     """If 10+ out of last 14 days are negative, show a gentle AI prompt and TTS suggestion."""
     moods = last_n_days_moods(14)
@@ -298,22 +644,84 @@ def gentle_depression_check_and_prompt():
     neg = count_negative_days(moods)
     if neg >= 10:
         # get user's name if available
-        profile = st.session_state.get('user_profile') or get_setting('user_profile')
+        profile = st.session_state.get('user_profile')
         name = (profile.get('name') if isinstance(profile, dict) else None) or 'friend'
         msg = f"Hey {name} 🌷, I noticed you’ve been feeling quite low recently. Would you like to try a calming meditation or talk about what’s been heavy lately?"
         st.warning(msg)
         if voice_allowed():
             audio = tts_cheerful(msg)
             if audio:
-                try:
-                    b64 = base64.b64encode(audio).decode('utf-8')
-                    data_uri = f"data:audio/mp3;base64,{b64}"
-                    st.markdown(f'<audio src="{data_uri}" autoplay controls></audio>', unsafe_allow_html=True)
-                except Exception:
-                    st.audio(audio, format='audio/mp3')
+                play_audio(audio)
         return True
     return False
 
+# Music-tab playlist keys in dropdown order, and each key's position for the default index.
+_MOOD_OPTIONS = ("Calm", "Sad", "Anxious", "Happy")
+_OPTION_IDX = {o: i for i, o in enumerate(_MOOD_OPTIONS)}
+
+# Bundled track for each playlist key (files under STATIC_DIR).
+_MOOD_LINKS = {
+    "Calm": "scott-buckley-moonlight(chosic.com).mp3",
+    "Sad": "Sonder(chosic.com).mp3",
+    "Anxious": "New-Beginnings-chosic.com_.mp3",
+    "Happy": "fm-freemusic-inspiring-optimistic-upbeat-energetic-guitar-rhythm(chosic.com).mp3",
+}
+
+# Keyword fragment -> playlist key for routing a free-form mood label; the leftmost hit wins.
+_KW2MOOD = {
+    'anx': 'Anxious', 'panic': 'Anxious', 'worri': 'Anxious',
+    'sad': 'Sad', 'down': 'Sad',
+    'happy': 'Happy', 'joy': 'Happy', 'good': 'Happy',
+    'calm': 'Calm', 'relax': 'Calm',
+}
+
+# Whole-word labels the model usually returns, resolved by one dict probe before the regex scan.
+# Every entry contains its _KW2MOOD fragment, so both paths agree.
+_LABEL2MOOD = {
+    'anxious': 'Anxious', 'anxiety': 'Anxious', 'panic': 'Anxious', 'panicked': 'Anxious', 'worried': 'Anxious',
+    'sad': 'Sad', 'down': 'Sad',
+    'happy': 'Happy', 'joy': 'Happy', 'joyful': 'Happy', 'good': 'Happy',
+    'calm': 'Calm', 'relaxed': 'Calm',
+}
+
+def route_mood(label):
+    """Playlist key for a free-form mood label, or None when no keyword matches."""
+    lmood = (label or "").strip().lower()
+    if lmood in _LABEL2MOOD:
+        return _LABEL2MOOD[lmood]
+    hit = get_mood_router().search(lmood)
+    return _KW2MOOD[hit.group()] if hit else None
+
+@st.cache_resource
+def get_mood_router():
+    """Compiled keyword router, built once per process rather than on every script rerun."""
+    return re.compile('|'.join(map(re.escape, _KW2MOOD)))
+
+# Bundled mood tracks live here; with server.enableStaticServing they're served at app/static/.
+STATIC_DIR = 'static'
+
+@st.cache_resource
+def get_mood_track_urls():
+    """Browser URL per playlist key, resolved once per process; keys whose track isn't
+    statically served (serving off, file missing) are left out."""
+    if not st.get_option('server.enableStaticServing'):
+        return {}
+    return {key: f"app/static/{quote(name)}" for key, name in _MOOD_LINKS.items()
+            if os.path.exists(os.path.join(STATIC_DIR, name))}
+
+# cache_resource returns the same immutable bytes object on every hit; cache_data would
+# unpickle a fresh multi-MB copy of the track on each rerun.
+@st.cache_resource(max_entries=8, show_spinner=False)
+def _load_audio(path: str):
+    """Bytes of a bundled mood track, read once per process; None if it isn't on disk."""
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        return f.read()
+
+# chats shown per page in the Chat History expander
+HISTORY_PAGE_SIZE = 20
+
 # Small pool of positive affirmations
 AFFIRMATIONS = [
     "You are doing your best — and that is enough.",
@@ -328,7 +736,7 @@ def show_affirmation_and_checkin():
     st.info(f"💛 {aff}")
     # gentle check-in if last mood negative
     moods = last_n_days_moods(1)
-    if moods and any(k in (moods[0][1] or '') for k in NEGATIVE_KEYWORDS):
+    if moods and is_negative(moods[0][1]):
         st.info("Gentle check-in: I noticed your last mood looked a bit low. Would you like a short breathing exercise?")
 
 
@@ -343,7 +751,7 @@ def show_daily_affirmation_if_needed():
         aff = random.choice(AFFIRMATIONS)
         st.info(f"💛 {aff}")
         moods = last_n_days_moods(1)
-        if moods and any(k in (moods[0][1] or '') for k in NEGATIVE_KEYWORDS):
+        if moods and is_negative(moods[0][1]):
             st.info("Gentle check-in: I noticed your last mood looked a bit low. Would you like a short breathing exercise?")
         try:
             set_setting('last_affirmation_date', today)
@@ -377,7 +785,7 @@ if 'daily_affirmation_shown' not in st.session_state:
 # Sidebar control: explicit Enable Voice gesture
 with st.sidebar:
     st.markdown("## Preferences")
-    persisted_voice = get_setting('voice_enabled', False)
+    persisted_voice = get_cached_setting('voice_enabled', False)
     col_a, col_b = st.columns([2,1])
     with col_a:
         en = st.button("Enable Voice 🔊")
@@ -426,16 +834,14 @@ with st.sidebar:
                 if voice_allowed():
                     audio = text_to_speech(aff)
                     if audio:
-                        try:
-                            b64 = base64.b64encode(audio).decode('utf-8')
-                            data_uri = f"data:audio/mp3;base64,{b64}"
-                            st.markdown(f'<audio src="{data_uri}" autoplay controls></audio>', unsafe_allow_html=True)
-                        except Exception:
-                            st.audio(audio, format='audio/mp3')
+                        play_audio(audio)
                 st.session_state['seen_affirmation_on_login'] = True
 
 # --- Onboarding / Name personalization ----------------------------------
-profile = get_setting('user_profile', None)
+# Resolve the profile once per session; the sidebar, Chat and Journal tabs read it from here.
+if 'user_profile' not in st.session_state:
+    st.session_state['user_profile'] = get_cached_setting('user_profile', None)
+profile = st.session_state['user_profile']
 with st.sidebar.expander("Your Profile", expanded=True):
     if profile:
         name = profile.get('name') if isinstance(profile, dict) else None
@@ -445,6 +851,7 @@ with st.sidebar.expander("Your Profile", expanded=True):
         st.write(f"Pronouns: {pronouns or '—'}\nBaseline mood: {baseline or '—'}")
         if st.button("Edit profile"):
             profile = None
+            st.session_state['user_profile'] = None
             set_setting('user_profile', None)
             safe_rerun()
     else:
@@ -464,9 +871,11 @@ with st.sidebar.expander("Your Profile", expanded=True):
                 st.success(f"Thanks — I'll call you {name_in.strip()} from now on!")
                 safe_rerun()
 
-# reflect profile into session state for immediate use
-if 'user_profile' not in st.session_state:
-    st.session_state['user_profile'] = profile
+# personalize prompts with the saved name when available (shared by the Chat and Journal tabs)
+_profile = st.session_state['user_profile']
+DISPLAY_NAME = _profile.get('name') if isinstance(_profile, dict) else None
+PLACEHOLDER_CHAT = f"Hi {DISPLAY_NAME}, how are you feeling today?" if DISPLAY_NAME else "How are you feeling today?"
+PLACEHOLDER_JOURNAL = f"Write or record your thoughts, {DISPLAY_NAME}:" if DISPLAY_NAME else "Write or record your thoughts:"
 
 tabs = st.tabs(["💬 Chat", "📓 Journal", "🧘 Mindfulness", "🧘‍♀️ Yoga", "📊 Progress", "🎵 Music"])
 
@@ -474,13 +883,7 @@ tabs = st.tabs(["💬 Chat", "📓 Journal", "🧘 Mindfulness", "🧘‍♀️
 with tabs[0]:
     st.subheader("💬 Talk to MindMate")
     st.session_state.voice = st.checkbox("🔊 Voice Responses", value=st.session_state.voice)
-    # personalize prompt with saved name when available
-    profile = st.session_state.get('user_profile') or get_setting('user_profile', None)
-    display_name = None
-    if profile and isinstance(profile, dict):
-        display_name = profile.get('name')
-    placeholder_text = f"Hi {display_name}, how are you feeling today?" if display_name else "How are you feeling today?"
-    user_message = st.text_input(placeholder_text, placeholder="Type your thoughts here...")
+    user_message = st.text_input(PLACEHOLDER_CHAT, placeholder="Type your thoughts here...")
 
     audio_input = st.audio_input("🎙️ Record your message (optional)")
     if audio_input:
@@ -491,63 +894,75 @@ with tabs[0]:
 
     if st.button("Send") and user_message.strip():
         try:
-            mood_res = client.chat.completions.create(
-                model="llama-3.1-8b-instant",
-                messages=[
-                    {"role": "system", "content": "Classify mood in one word"},
-                    {"role": "user", "content": user_message}
-                ],
-                temperature=0.2
-            )
-            mood = mood_res.choices[0].message.content.strip()
-
+            speak = voice_allowed()
+            # One round trip: the reply opens with a "[mood: X]" tag that is stripped
+            # from the stream before display.
             bot_res = client.chat.completions.create(
                 model="llama-3.1-8b-instant",
                 messages=[
-                    {"role": "system", "content": "You are MindMate, an empathetic mental health companion."},
+                    {"role": "system", "content": "You are MindMate, an empathetic mental health companion. "
+                                                  "Begin every reply with the user's mood as one word in the form "
+                                                  "[mood: <word>], then give your response."},
                     {"role": "user", "content": user_message}
                 ],
-                temperature=0.7
+                temperature=0.6,
+                stream=True
             )
-            bot_message = bot_res.choices[0].message.content.strip()
+            st.markdown(f"**You:** {user_message}")
+            st.markdown("**MindMate:**")
+            found = {}
+            bot_message, audio = stream_reply_with_tts(strip_mood_tag(stream_tokens(bot_res), found), speak)
+            mood = found.get('mood')
+            if not mood:
+                # model skipped the tag; fall back to a dedicated classification call
+                mood_res = client.chat.completions.create(
+                    model="llama-3.1-8b-instant",
+                    messages=[
+                        {"role": "system", "content": "Classify mood in one word"},
+                        {"role": "user", "content": user_message}
+                    ],
+                    temperature=0.2
+                )
+                mood = mood_res.choices[0].message.content.strip()
 
             insert_chat(user_message, bot_message, mood)
 
             st.info(f"🧠 Mood: **{mood}**")
-            st.markdown(f"**You:** {user_message}")
-            st.markdown(f"**MindMate:** {bot_message}")
 
-            if voice_allowed():
-                audio = text_to_speech(bot_message)
-                if audio:
-                    try:
-                        # Convert raw audio bytes to base64 so we can embed as data URI
-                        b64 = base64.b64encode(audio).decode('utf-8')
-                        data_uri = f"data:audio/mp3;base64,{b64}"
-                        # Render an autoplaying HTML audio element. This is triggered by the
-                        # user's Send button click (user gesture) which improves browser autoplay
-                        # permission chances. Keep Streamlit's st.audio as a fallback UI.
-                        st.markdown(f'<audio src="{data_uri}" autoplay controls></audio>', unsafe_allow_html=True)
-                    except Exception:
-                        # If embedding fails for any reason, fall back to st.audio
-                        st.audio(audio, format="audio/mp3")
+            # autoplay is triggered by the Send click (a user gesture), which
+            # improves browser autoplay permission chances
+            if speak and audio:
+                play_audio(audio)
         except Exception as e:
             st.error(f"❌ Error: {e}")
 
     with st.expander("🕒 Chat History"):
-        for ts, u, b, m in get_chat_history():
-            st.markdown(f"🗓️ `{ts}` | 😌 **{m}**")
-            st.markdown(f"- **You:** {u}")
-            st.markdown(f"- **MindMate:** {b}")
-            st.markdown("---")
+        # one page at a time; fetch one extra row to know whether a next page exists
+        page = st.session_state.setdefault('chat_hist_page', 0)
+        rows = get_chat_history(limit=HISTORY_PAGE_SIZE + 1, offset=page * HISTORY_PAGE_SIZE)
+        has_next = len(rows) > HISTORY_PAGE_SIZE
+        # one markdown element for the whole page instead of four per row
+        history_md = "\n\n".join(
+            f"🗓️ `{ts}` | 😌 **{m}**\n\n- **You:** {u}\n- **MindMate:** {b}\n\n---"
+            for ts, u, b, m in rows[:HISTORY_PAGE_SIZE]
+        )
+        if history_md:
+            st.markdown(history_md)
+        if page or has_next:
+            prev_col, info_col, next_col = st.columns([1, 2, 1])
+            with prev_col:
+                st.button("◀ Newer", disabled=page == 0, key='chat_hist_prev',
+                          on_click=lambda: st.session_state.update(chat_hist_page=page - 1))
+            with info_col:
+                st.caption(f"Page {page + 1}")
+            with next_col:
+                st.button("Older ▶", disabled=not has_next, key='chat_hist_next',
+                          on_click=lambda: st.session_state.update(chat_hist_page=page + 1))
 
 # 📓 JOURNAL TAB
 with tabs[1]:
     st.subheader("📓 Daily Journal")
-    profile = st.session_state.get('user_profile') or get_setting('user_profile', None)
-    display_name = profile.get('name') if profile and isinstance(profile, dict) else None
-    journal_label = f"Write or record your thoughts, {display_name}:" if display_name else "Write or record your thoughts:"
-    entry = st.text_area(journal_label, height=150)
+    entry = st.text_area(PLACEHOLDER_JOURNAL, height=150)
     audio_journal = st.audio_input("🎙️ Record journal entry")
     if audio_journal:
         text = transcribe_audio(audio_journal.read())
@@ -564,28 +979,27 @@ with tabs[1]:
                     {"role": "system", "content": "Provide short, positive encouragement"},
                     {"role": "user", "content": entry}
                 ],
-                temperature=0.7
+                temperature=0.7,
+                stream=True
             )
-            note = res.choices[0].message.content.strip()
             st.success("✅ Saved!")
-            st.info(f"💬 {note}")
-            if voice_allowed():
-                # read the encouragement aloud in a cheerful way
-                audio = tts_cheerful(note)
-                if audio:
-                    try:
-                        b64 = base64.b64encode(audio).decode('utf-8')
-                        data_uri = f"data:audio/mp3;base64,{b64}"
-                        st.markdown(f'<audio src="{data_uri}" autoplay controls></audio>', unsafe_allow_html=True)
-                    except Exception:
-                        st.audio(audio, format="audio/mp3")
+            speak = voice_allowed()
+            # synthesize sentence by sentence while the note streams in, then restyle it in place
+            note_slot = st.empty()
+            with note_slot.container():
+                note, audio = stream_reply_with_tts(stream_tokens(res), speak)
+            note_slot.info(f"💬 {note}")
+            if speak and audio:
+                # read the encouragement aloud in a cheerful way; the fixed sign-off is cached
+                cheer = text_to_speech(CHEERFUL_SUFFIX)
+                play_audio(audio + (cheer or b""))
         except:
             st.info("💬 Thanks for sharing! You're doing great 🌟")
 
     st.markdown("### 📅 Past Entries")
-    for d, e in get_journal_history():
-        st.markdown(f"🗓️ **{d}**: _{e}_")
-        st.markdown("---")
+    journal_md = "\n\n".join(f"🗓️ **{d}**: _{e}_\n\n---" for d, e in get_journal_history())
+    if journal_md:
+        st.markdown(journal_md)
 
 # 🧘 MINDFULNESS
 with tabs[2]:
@@ -608,71 +1022,33 @@ with tabs[2]:
     st.session_state.setdefault("mindfulness_sessions", 0)
     st.session_state.setdefault("meditation_sessions", 0)
 
-    def _play_bytes(audio_bytes):
-        try:
-            b64 = base64.b64encode(audio_bytes).decode('utf-8')
-            data_uri = f"data:audio/mp3;base64,{b64}"
-            st.markdown(f'<audio src="{data_uri}" autoplay controls></audio>', unsafe_allow_html=True)
-        except Exception:
-            st.audio(audio_bytes, format="audio/mp3")
-
     if start:
         total_seconds = minutes * 60
-        placeholder = st.empty()
-        prog = st.progress(0)
-        elapsed = 0
 
         if exercise in ("4-4-4 Breathing", "Box Breathing"):
-            cycle_seconds = 12 if exercise == "4-4-4 Breathing" else 16  # Box has extra hold
+            phases = [("Inhale", 4), ("Hold", 4), ("Exhale", 4)]
+            if exercise == "Box Breathing":
+                phases.append(("Hold", 4))  # Box has extra hold
+            cycle_seconds = sum(sec for _, sec in phases)
             cycles = max(1, total_seconds // cycle_seconds)
             st.info(f"Starting {exercise} for {minutes} minute(s). {cycles} cycles will run.")
 
-            for c in range(cycles):
-                # Inhale
-                placeholder.markdown(f"### Cycle {c+1}/{cycles}: Inhale (4s)")
-                if voice_allowed():
-                    audio = text_to_speech("Inhale")
-                    if audio:
-                        _play_bytes(audio)
-                for i in range(4):
-                    time.sleep(1)
-                    elapsed += 1
-                    prog.progress(min(elapsed / total_seconds, 1.0))
-
-                # Hold
-                placeholder.markdown("### Hold (4s)")
-                if voice_allowed():
-                    audio = text_to_speech("Hold")
-                    if audio:
-                        _play_bytes(audio)
-                for i in range(4):
-                    time.sleep(1)
-                    elapsed += 1
-                    prog.progress(min(elapsed / total_seconds, 1.0))
-
-                # Exhale
-                placeholder.markdown("### Exhale (4s)")
-                if voice_allowed():
-                    audio = text_to_speech("Exhale")
-                    if audio:
-                        _play_bytes(audio)
-                for i in range(4):
-                    time.sleep(1)
-                    elapsed += 1
-                    prog.progress(min(elapsed / total_seconds, 1.0))
-
-        elif exercise == "Visualization":
-            placeholder.markdown("### Visualization: Close your eyes and begin")
+            # Synthesize the cues up front (in parallel); the page replays the same clips every cycle.
+            cue_names = ["Inhale", "Hold", "Exhale"]
+            cue_uris = dict.fromkeys(cue_names)
             if voice_allowed():
-                audio = text_to_speech("Close your eyes and picture a calm scene. Breathe slowly and notice details.")
-                if audio:
-                    _play_bytes(audio)
-            # simple countdown
-            for s in range(total_seconds):
-                time.sleep(1)
-                prog.progress(min((s+1) / total_seconds, 1.0))
+                cue_uris = dict(zip(cue_names, prefetch_tts(cue_names, synth=tts_data_uri)))
+        else:
+            phases = [("Visualization: Close your eyes and begin", total_seconds)]
+            cycles = 1
+            cue_uris = {phases[0][0]: None}
+            if voice_allowed():
+                cue_uris[phases[0][0]] = prefetch_tts(
+                    ["Close your eyes and picture a calm scene. Breathe slowly and notice details."],
+                    synth=tts_data_uri)[0]
 
-        placeholder.success("✔️ Session complete — well done!")
+        # The whole session runs in the browser; the script thread isn't held for its duration.
+        embed_html(breathing_session_html(phases, cycles, cue_uris), height=380)
         # increment counters
         st.session_state.mindfulness_sessions = st.session_state.get("mindfulness_sessions", 0) + 1
         st.session_state.meditation_sessions = st.session_state.get("meditation_sessions", 0) + 1
@@ -712,30 +1088,27 @@ with tabs[3]:
         placeholder = st.empty()
         prog = st.progress(0)
         total_steps = len(poses[pose])
-        elapsed = 0
-        total_seconds = total_steps * hold_seconds
+        # synthesize every step's cue in parallel before the flow so holds aren't delayed by TTS
+        speak = voice_allowed()
+        step_audio = prefetch_tts(poses[pose]) if speak else [None] * total_steps
+        # sleep to absolute deadlines so TTS/render time doesn't accumulate as drift
+        flow_start = time.monotonic()
 
-        for i, step in enumerate(poses[pose], start=1):
+        for i, (step, audio) in enumerate(zip(poses[pose], step_audio), start=1):
             placeholder.markdown(f"### Step {i}/{total_steps}: {step}")
-            if voice_allowed():
-                audio = text_to_speech(step)
+            if speak:
                 if audio:
-                    try:
-                        b64 = base64.b64encode(audio).decode('utf-8')
-                        data_uri = f"data:audio/mp3;base64,{b64}"
-                        st.markdown(f'<audio src="{data_uri}" autoplay controls></audio>', unsafe_allow_html=True)
-                    except Exception:
-                        st.audio(audio, format="audio/mp3")
+                    play_audio(audio)
                 # save last AI mood so Music tab can default to it
                 try:
                     set_setting('last_ai_mood', mood)
                 except Exception:
                     pass
 
-            for s in range(hold_seconds):
-                time.sleep(1)
-                elapsed += 1
-                prog.progress(min(elapsed / total_seconds, 1.0))
+            # one wake-up and one progress update per step instead of one per second
+            deadline = flow_start + i * hold_seconds
+            time.sleep(max(0, deadline - time.monotonic()))
+            prog.progress(i / total_steps)
 
         placeholder.success("✔️ Yoga flow complete — great job!")
         st.session_state.yoga_sessions = st.session_state.get("yoga_sessions", 0) + 1
@@ -815,33 +1188,10 @@ with tabs[4]:
     st.info(encourage)
 
     # --- Mood trend chart (restore detailed trend view) ---
-    # Build a simple trend chart using the last messages we collected above
-    chats = get_chat_history()
-    messages = []
-    mood_counts = Counter()
-    for ts, user_msg, assistant_msg, mood in chats:
-        if mood:
-            mood_counts[mood.lower()] += 1
-        messages.append((ts, user_msg, assistant_msg, mood))
-
-    if messages:
-        bins = 6
-        bucket_size = max(1, len(messages) // bins)
-        unique_moods = list({m for _, _, _, m in messages if m})
-        bucket_series = {m: [] for m in unique_moods}
-        for i in range(0, len(messages), bucket_size):
-            part = messages[i:i+bucket_size]
-            counts = Counter()
-            for _, umsg, _, umood in part:
-                if umood:
-                    counts[umood.lower()] += 1
-            for m in unique_moods:
-                bucket_series[m].append(counts.get(m.lower(), 0))
-
-        chart_data = {}
-        for m in unique_moods:
-            chart_data[m.capitalize()] = bucket_series[m]
-        if chart_data:
+    # Cached per chats version, so the trend is only rebuilt after a new chat.
+    chart_data = get_mood_trend(limit=200)  # trend covers the 200 most recent chats
+    if chart_data is not None:
+        if len(chart_data.columns):
             st.markdown("### 📈 Mood trend over time")
             st.line_chart(chart_data)
     else:
@@ -851,37 +1201,10 @@ with tabs[4]:
 # 🎵 MUSIC
 with tabs[5]:
     st.subheader("🎵 Mood Music")
-    # Try to default the dropdown to the last AI-predicted mood (map to our available keys)
-    options = ["Calm", "Sad", "Anxious", "Happy"]
-    default_mood = None
-    try:
-        last = get_chat_history()
-        if last:
-            # most recent chat is first row (timestamp, user_message, assistant_message, mood)
-            lmood = (last[0][3] or "").lower()
-            if 'anx' in lmood or 'panic' in lmood or 'worri' in lmood:
-                default_mood = "Anxious"
-            elif 'sad' in lmood or 'down' in lmood:
-                default_mood = "Sad"
-            elif 'happy' in lmood or 'joy' in lmood or 'good' in lmood:
-                default_mood = "Happy"
-            elif 'calm' in lmood or 'relax' in lmood:
-                default_mood = "Calm"
-    except Exception:
-        default_mood = None
-
-    try:
-        idx = options.index(default_mood) if default_mood in options else 0
-    except Exception:
-        idx = 0
-    mood = st.selectbox("How are you feeling?", options, index=idx)
-    # Use reliable direct MP3 URLs (SoundHelix samples) to ensure Streamlit can play them
-    links = {
-        "Calm": "scott-buckley-moonlight(chosic.com).mp3",
-        "Sad": "Sonder(chosic.com).mp3",
-        "Anxious": "New-Beginnings-chosic.com_.mp3",
-        "Happy": "fm-freemusic-inspiring-optimistic-upbeat-energetic-guitar-rhythm(chosic.com).mp3"
-    }
+    # Default the dropdown to the last AI-predicted mood (map to our available keys).
+    # get_last_mood() is None with no chats, and route_mood(None) is None -> index 0.
+    idx = _OPTION_IDX.get(route_mood(get_last_mood()), 0)
+    mood = st.selectbox("How are you feeling?", _MOOD_OPTIONS, index=idx)
     # Play selected mood music (validate key)
     # Store the mood key in session state (not raw URL) so Play/Stop is mood-based
     if 'music_to_play' not in st.session_state:
@@ -900,46 +1223,33 @@ with tabs[5]:
         if st.button("⏹️ Stop Music"):
             st.session_state.music_to_play = None
 
-    # Resolve the file/URL for the currently selected mood and the stored play mood
-    selected_url = links.get(mood)
-    play_key = st.session_state.music_to_play
-    play_url = links.get(play_key) if play_key else None
-
-    def _render_audio_from_path(path):
+    # One slot for the player, so switching between the URL player, the st.audio fallback
+    # and the warning replaces the element in place instead of shifting the page.
+    player_slot = st.empty()
+
+    def _render_mood_player(key, autoplay):
+        url = get_mood_track_urls().get(key)
+        if url:
+            # Plain URL: the browser range-requests the file instead of receiving it over the websocket.
+            player_slot.markdown(
+                f'<audio src="{url}" controls{" autoplay" if autoplay else ""}></audio>',
+                unsafe_allow_html=True,
+            )
+            return
+        # Only the disk fallback can fail (missing or unreadable file under STATIC_DIR).
         try:
-            # If path looks like an http URL, embed directly. Otherwise read local bytes.
-            if path.startswith('http'):
-                st.markdown(f'<audio src="{path}" autoplay controls></audio>', unsafe_allow_html=True)
-                st.audio(path, format='audio/mp3')
-            else:
-                # local file in workspace
-                if os.path.exists(path):
-                    with open(path, 'rb') as f:
-                        data = f.read()
-                    b64 = base64.b64encode(data).decode('utf-8')
-                    data_uri = f"data:audio/mp3;base64,{b64}"
-                    st.markdown(f'<audio src="{data_uri}" autoplay controls></audio>', unsafe_allow_html=True)
-                    st.audio(data, format='audio/mp3')
-                else:
-                    # Fall back to Streamlit audio by passing the path (Streamlit may serve it)
-                    st.audio(path, format='audio/mp3')
+            data = _load_audio(os.path.join(STATIC_DIR, _MOOD_LINKS[key]))
         except Exception:
-            try:
-                st.audio(path, format='audio/mp3')
-            except Exception:
-                st.warning("Unable to play audio for this mood.")
+            data = None
+        if data is None:
+            player_slot.warning("Unable to play audio for this mood.")
+            return
+        with player_slot:
+            play_audio(data, autoplay=autoplay)
+
+    # Exactly one player: the playing mood autoplays, otherwise preview the selection.
+    play_key = st.session_state.music_to_play
+    _render_mood_player(play_key or mood, autoplay=bool(play_key))
 
-    # If a mood is currently playing, render autoplaying player for that mood
-    if play_url:
-        _render_audio_from_path(play_url)
-    else:
-        # Show the selected mood's player but don't autoplay
-        if selected_url:
-            try:
-                if os.path.exists(selected_url):
-                    with open(selected_url, 'rb') as f:
-                        st.audio(f.read(), format='audio/mp3')
-                else:
-                    st.audio(selected_url, format='audio/mp3')
-            except Exception:
-                st.warning("Unable to render audio for the selected mood.")
\ No newline at end of file
+# Commit any chat/journal writes buffered during this run in one transaction.
+flush_writes()